@@ -4,9 +4,32 @@ import os
 import json
 import re
 import socket
+import fcntl
+import struct
 from optparse import OptionParser
 from functools import partial
-from subprocess import call, check_output
+from concurrent.futures import ThreadPoolExecutor
+from subprocess import call, Popen, PIPE
+
+# python-openvswitch lets us speak OVSDB JSON-RPC directly instead of
+# forking ovs-vsctl (which reparses the whole config on every exec)
+try:
+    import ovs.jsonrpc
+    import ovs.stream
+except ImportError:
+    ovs = None
+
+# pyroute2 answers routing queries with one netlink call, no subprocess
+try:
+    from pyroute2 import IPRoute
+except ImportError:
+    IPRoute = None
+
+# numpy batch-formats host names/addresses for very large topologies
+try:
+    import numpy as np
+except ImportError:
+    np = None
 
 from mininet.net import Mininet
 from mininet.topo import Topo
@@ -39,6 +62,9 @@ def parseOptions():
 
 opts, args = parseOptions()
 
+# set link speeds to 10Mb/s
+_LINKOPTS = {'bw': 10}
+
 class LeafAndSpine(Topo):
     # spine = number of spine switches
     # leaf = number of leaf switches which are connected to all of the spines
@@ -53,118 +79,223 @@ class LeafAndSpine(Topo):
 
         # Initialize topology
         Topo.__init__(self, **opts)
+        # bind the add methods once, the loops below run
+        # O(spine*leaf*fanout) times
+        addSwitch = self.addSwitch
+        addHost = self.addHost
+        addLink = self.addLink
         # Initialize  spine switches
         spines = {}
         for s in range(spine):
-            spines[s] = self.addSwitch('s%s' % (s + 1), protocols='OpenFlow13')
-        # set link speeds to 10Mb/s
-        linkopts = dict(bw=10)
+            spines[s] = addSwitch(f's{s+1}', protocols='OpenFlow13')
+        # for stress-test sized topologies format all the host names and
+        # addresses in one vectorized pass rather than per host in the loop
+        n = leaf * fanout
+        if np is not None and n >= 1024:
+            idx = np.arange(n)
+            lsArr, fArr = np.divmod(idx, fanout)
+            hosts = list(zip(
+                np.char.mod('h%d', idx + 1).tolist(),
+                np.char.add(np.char.mod('10.0.%d.', lsArr),
+                            np.char.mod('%d/16', fArr + 1)).tolist(),
+                np.char.add(np.char.mod('00:04:00:00:%02x:', lsArr),
+                            np.char.mod('%02x', fArr + 1)).tolist()))
+        else:
+            hosts = None
         for ls in range(leaf):
-            leafSwitch = self.addSwitch('s%s' % (spine+ls+1), protocols='OpenFlow13')
+            leafSwitch = addSwitch(f's{spine+ls+1}', protocols='OpenFlow13')
             # now connect the leaf to all the spines
             for s in range(spine):
-                switch = spines[s]
-                self.addLink(leafSwitch, switch, **linkopts)
-            # Add hosts and leaf switches, fanout hosts per leaf switch 
+                addLink(leafSwitch, spines[s], **_LINKOPTS)
+            # Add hosts and leaf switches, fanout hosts per leaf switch
+            # set the MAC here so the namespace comes up with it, rather
+            # than patching it with ip link afterwards; the unicast flows
+            # are derived from the same (leaf, host) encoding
             for f in range(fanout):
-                host = self.addHost('h%s' % (ls*fanout+f+1), ip='10.0.%s.%s/16' % (ls, (f+1)))
-                self.addLink(host, leafSwitch, **linkopts)
+                if hosts is not None:
+                    name, ip, mac = hosts[ls*fanout+f]
+                else:
+                    name = f'h{ls*fanout+f+1}'
+                    ip = f'10.0.{ls}.{f+1}/16'
+                    mac = f'00:04:00:00:{ls:02x}:{f+1:02x}'
+                host = addHost(name, ip=ip, mac=mac)
+                addLink(host, leafSwitch, **_LINKOPTS)
+
+# Names of the switches in Mininet creation order: spines first, then
+# leaves; computed once and shared by the config* functions
+def switchNames(spine, leaf):
+    spineNames = [f's{s+1}' for s in range(spine)]
+    leafNames = [f's{spine+ls+1}' for ls in range(leaf)]
+    return spineNames, leafNames
+
+# Apply a generated program of 'flow add ...' and 'group add ...' mods to
+# a switch with a single ovs-ofctl invocation, committed atomically as one
+# bundle; ovs-ofctl follows the bundle commit with one
+# OFPT_BARRIER_REQUEST, so the datapath revalidates once per batch rather
+# than once per mod
+def applyMods(switch, mods):
+    p = Popen(['ovs-ofctl', '-O', 'OpenFlow13', 'bundle', switch, '-'],
+              stdin=PIPE)
+    p.communicate(('\n'.join(mods) + '\n').encode())
+
+# all switches flood multicasts (including ARP)
+_FLOOD_FLOW = 'dl_dst=01:00:00:00:00:00/01:00:00:00:00:00 priority=400 actions=flood'
 
 def configMulticast(spine, leaf, fanout):
-    for ls in range(leaf):
-        switch = 's%s' % (spine+ls+1)
+    spineNames, leafNames = switchNames(spine, leaf)
+    for switch in leafNames:
         # disable flood on all but one of the uplinks
         for p in range(2, spine+1):
             # the uplinks are added first so numbered from 1
-            call(['ovs-ofctl', 'mod-port', switch, str(p), 'noflood']) 
-        # leaf switches flood multicasts (including ARP)
-        call(['ovs-ofctl', 'add-flow', switch, 'dl_dst=01:00:00:00:00:00/01:00:00:00:00:00 priority=400 actions=flood'])
-    for s in range(spine):
-        # spine switches flood multicasts
-        switch = 's%s' % (s+1)
-        call(['ovs-ofctl', 'add-flow', switch, 'dl_dst=01:00:00:00:00:00/01:00:00:00:00:00 priority=400 actions=flood'])
+            call(['ovs-ofctl', 'mod-port', switch, str(p), 'noflood'])
+        applyMods(switch, ['flow add ' + _FLOOD_FLOW])
+    for switch in spineNames:
+        applyMods(switch, ['flow add ' + _FLOOD_FLOW])
 
 #Configure OVS forwarding, multipathing for non-local hosts
-def configUnicast(net, spine, leaf, fanout):
-    for ls in range(leaf):
-        lsname = 's%s' % (spine+ls+1)
+def configUnicast(spine, leaf, fanout):
+    spineNames, leafNames = switchNames(spine, leaf)
+    # the uplinks are the same on every leaf, so the bucket list is too
+    buckets = ','.join('bucket=output:%s' % x for x in range(1, spine+1))
+    # configure one leaf switch and return the flows the spines need for
+    # its hosts; the leaves are independent so these run in parallel
+    def configureLeaf(ls):
+        # generate the switch's whole program — select group over the
+        # uplinks, the default multipath rule pointing at it, and the
+        # per-host rules — and apply it with one ovs-ofctl
+        mods = ['group add group_id=%s,type=select,%s' % (ls+1, buckets),
+                'flow add priority=300 actions=group:%s' % (ls+1)]
+        spineFlows = []
         for f in range(fanout):
-            # host.MAC() returns IP so we set the MAC and use in flow here!
+            # the MAC assigned by LeafAndSpine at addHost time
             mac = '00:04:00:00:{:02x}:{:02x}'.format (ls, (f+1))
-            host = net.get('h%s' % (ls*fanout+f+1))
-            host.setMAC(mac)
             # rule for hosts connected to this leaf switch
-            call(['ovs-ofctl', 'add-flow', lsname, 'dl_dst=%s priority=500 actions=output:%s' % (mac, (f+1+spine))])
-            # now add the multipathing rules for hosts not connected to the leaf switch
-            # note that symmetric_l4 hash uses ip and tcp field, but not udp
-            # so udp flows between a pair of hosts will always use same link. 
-            slaves = '1'
-            if (spine > 1): 
-                for x in range(2,spine+1): slaves=slaves+','+str(x)
-            call(['ovs-ofctl', 'add-flow', lsname, 'priority=300 actions=bundle(symmetric_l4,%s,hrw,ofport,slaves:%s' % (ls+1, slaves)])
+            mods.append('flow add dl_dst=%s priority=500 actions=output:%s' % (mac, (f+1+spine)))
             # now tell the spines about the hosts
-            for s in range(spine):
-                sname = 's%s' % (s+1)
-                call(['ovs-ofctl', 'add-flow', sname, 'dl_dst=%s priority=500 actions=output:%s' % (mac, str(ls+1))])
+            spineFlows.append('flow add dl_dst=%s priority=500 actions=output:%s' % (mac, str(ls+1)))
+        applyMods(leafNames[ls], mods)
+        return spineFlows
+    # the workers block in fork/exec and OVSDB I/O, so threads overlap
+    with ThreadPoolExecutor(max_workers=min(32, leaf)) as executor:
+        perLeaf = list(executor.map(configureLeaf, range(leaf)))
+    # the forwarding rules for a host are the same on every spine switch,
+    # so one program serves them all
+    spineFlows = [flow for flows in perLeaf for flow in flows]
+    for switch in spineNames:
+        applyMods(switch, spineFlows)
         
+OVSDB_SOCK = 'unix:/var/run/openvswitch/db.sock'
+
+# Send a single OVSDB transaction over the management socket and return
+# the reply
+def ovsdbTransact(operations):
+    error, stream = ovs.stream.Stream.open_block(
+        ovs.stream.Stream.open(OVSDB_SOCK))
+    if error:
+        raise OSError(error, 'failed to connect to %s' % OVSDB_SOCK)
+    rpc = ovs.jsonrpc.Connection(stream)
+    request = ovs.jsonrpc.Message.create_request(
+        'transact', ['Open_vSwitch'] + operations)
+    error, reply = rpc.transact_block(request)
+    rpc.close()
+    if error:
+        raise OSError(error, 'OVSDB transact failed')
+    return reply
+
 #Configure sFlow on OVS using the specified collector and ifname whose interface
 #is to be used as agent address
 def configSFlow(spine, leaf, collector, ifname):
-    sflow = 'ovs-vsctl -- --id=@sflow create sflow agent=%s target=%s sampling=10 polling=20 --' % (ifname, collector)
-    for s in range(1,spine+1):
-        sflow += ' -- set bridge s%s sflow=@sflow' % s
-    for ls in range(1,leaf+1):
-        sflow += ' -- set bridge s%s sflow=@sflow' % (spine+ls)
     info('*** Configuring sFlow collector=%s \n' % collector)
+    spineNames, leafNames = switchNames(spine, leaf)
+    switches = spineNames + leafNames
+    if ovs:
+        # one JSON-RPC transaction covering the sFlow row and every bridge
+        operations = [{'op': 'insert', 'table': 'sFlow', 'uuid-name': 'sflow',
+            'row': {'agent': ifname, 'targets': collector,
+                    'sampling': 10, 'polling': 20}}]
+        for switch in switches:
+            operations.append({'op': 'update', 'table': 'Bridge',
+                'where': [['name', '==', switch]],
+                'row': {'sflow': ['named-uuid', 'sflow']}})
+        ovsdbTransact(operations)
+        return
+    # fall back to ovs-vsctl, still as a single transaction
+    # --no-wait: don't block on ovs-vswitchd reloading the config
+    sflow = 'ovs-vsctl --no-wait -- --id=@sflow create sflow agent=%s target=%s sampling=10 polling=20 --' % (ifname, collector)
+    for switch in switches:
+        sflow += ' -- set bridge %s sflow=@sflow' % switch
     quietRun(sflow)
 
+SIOCGIFADDR = 0x8915
+
+# Returns the local IP address used when sending to ip address; the kernel
+# picks the egress interface for a connected UDP socket, so this is all
+# that's needed when only the agent IP matters
+def getAgentIP(ip):
+    s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    s.connect((ip, 0))
+    return s.getsockname()[0]
+
 # Looks up the interface used to when sending to ip address and returns
-# interface name and associated IP address.    
+# interface name and associated IP address.
 def getIfInfo(ip):
+    if IPRoute is not None:
+        # ask the kernel for the route directly: the reply carries the
+        # egress interface and preferred source address
+        with IPRoute() as ipr:
+            route = ipr.route('get', dst=ip)[0]
+            oif = route.get_attr('RTA_OIF')
+            return socket.if_indextoname(oif), route.get_attr('RTA_PREFSRC')
+    ip = getAgentIP(ip)
+    # one SIOCGIFADDR ioctl per interface, no subprocess and no parsing
     s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-    s.connect((ip, 0))
-    ip = s.getsockname()[0]
-    ifconfig = check_output(['ifconfig'])
-    ifs = re.findall(r'^(\S+).*?inet addr:(\S+).*?', ifconfig, re.S|re.M)
-    for entry in ifs:
-        if entry[1] == ip:
-            return entry
+    for index, ifname in socket.if_nameindex():
+        try:
+            ifreq = fcntl.ioctl(s.fileno(), SIOCGIFADDR,
+                                struct.pack('256s', ifname[:15].encode()))
+        except OSError:
+            # interface has no IPv4 address
+            continue
+        if socket.inet_ntoa(ifreq[20:24]) == ip:
+            return ifname, ip
     
-#write out the topology to topofile    
+#matches the switch ports named by Mininet, e.g. s1-eth2
+_IFACE_RE = re.compile(r'^(s[0-9]+)-(.*)')
+
+#write out the topology to topofile
 def dumpTopology(net, agent, topofile):
     topoData = {'nodes': {}, 'links': {}}
     for s in net.switches:
         topoData['nodes'][s.name] = {'name': s.name, 'dpid': s.dpid, 'ports': {},'agent': agent}
     path = '/sys/devices/virtual/net/'
-    for child in os.listdir(path):
-        parts = re.match('(^s[0-9]+)-(.*)', child)
+    for entry in os.scandir(path):
+        parts = _IFACE_RE.match(entry.name)
         if parts == None: continue
-        ifindex = open(path+child+'/ifindex').read().split('\n',1)[0]
-        topoData['nodes'][parts.group(1)]['ports'][child] = {'name': child, 'ifindex': ifindex}
-    i = 0
-    for s1 in net.switches:
-        j = 0
-        for s2 in net.switches:
-            if j > i:
-                intfs = s1.connectionsTo(s2)
-                for intf in intfs:
-                    s1ifIdx = topoData['nodes'][s1.name]['ports'][intf[0].name]['ifindex']
-                    s2ifIdx = topoData['nodes'][s2.name]['ports'][intf[1].name]['ifindex']
-                    linkName = '%s-%s' % (s1.name, s2.name)
-                    info('topology link %s: %s %s %s %s %s %s\n' % (linkName, s1, intf[0].name, s1ifIdx, s2, intf[1].name, s2ifIdx))
-                    topoData['links'][linkName] = {'node1': s1.name, 'port1': intf[0].name, 'ifindex1': s1ifIdx, 'node2': s2.name, 'port2': intf[1].name, 'ifindex2': s2ifIdx}
-            j += 1
-        i += 1
-    #now identify the leaf/edge switches
-    for h in net.hosts:
-        for s in net.switches:
-            intfs = h.connectionsTo(s)
-            if intfs:
-                topoData['nodes'][s.name]['tag'] = 'edge'
-    f = open(topofile, 'w')
-    f.write(json.dumps(topoData))
-    f.flush()
-    f.close  
+        # a single libc call, no sysfs file open/read per interface
+        ifindex = str(socket.if_nametoindex(entry.name))
+        topoData['nodes'][parts.group(1)]['ports'][entry.name] = {'name': entry.name, 'ifindex': ifindex}
+    # single pass over the links, rather than probing every switch pair
+    # with connectionsTo; a switch linked to a host is a leaf/edge switch
+    switchNames = set(topoData['nodes'])
+    hostNames = set(h.name for h in net.hosts)
+    for link in net.links:
+        intf1, intf2 = link.intf1, link.intf2
+        s1, s2 = intf1.node, intf2.node
+        if s1.name in hostNames and s2.name in switchNames:
+            topoData['nodes'][s2.name]['tag'] = 'edge'
+            continue
+        if s2.name in hostNames and s1.name in switchNames:
+            topoData['nodes'][s1.name]['tag'] = 'edge'
+            continue
+        if s1.name not in switchNames or s2.name not in switchNames: continue
+        s1ifIdx = topoData['nodes'][s1.name]['ports'][intf1.name]['ifindex']
+        s2ifIdx = topoData['nodes'][s2.name]['ports'][intf2.name]['ifindex']
+        linkName = '%s-%s' % (s1.name, s2.name)
+        info('topology link %s: %s %s %s %s %s %s\n' % (linkName, s1, intf1.name, s1ifIdx, s2, intf2.name, s2ifIdx))
+        topoData['links'][linkName] = {'node1': s1.name, 'port1': intf1.name, 'ifindex1': s1ifIdx, 'node2': s2.name, 'port2': intf2.name, 'ifindex2': s2ifIdx}
+    with open(topofile, 'w') as f:
+        # stream straight to the file, no intermediate string
+        json.dump(topoData, f, separators=(',', ':'))
 
 def config(opts):
     spine = opts.spine
@@ -178,7 +309,7 @@ def config(opts):
     net = Mininet(topo=topo, link=TCLink, controller=lambda name: RemoteController(name, ip=controller, port=controller_port))
     net.start()
 #configMulticast(spine=spine, leaf=leaf, fanout=fanout)
-#configUnicast(net=net, spine=spine, leaf=leaf, fanout=fanout)
+#configUnicast(spine=spine, leaf=leaf, fanout=fanout)
 #configSFlow(spine=spine, leaf=leaf, collector=collector, ifname=ifname)
 #dumpTopology(net=net, agent=agent, topofile=opts.topofile)
     CLI(net)